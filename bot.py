@@ -8,9 +8,13 @@ from logging.handlers import RotatingFileHandler
 from dotenv import load_dotenv
 import aiohttp
 import asyncio
+import functools
+from collections import defaultdict
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
 from firebase_admin import credentials, firestore, initialize_app
 from asyncprawcore.exceptions import ResponseException, NotFound
-from urllib.parse import urlparse, urlunparse
 
 # Ensure the logs directory exists
 if not os.path.exists("logs"):
@@ -26,6 +30,7 @@ logging.basicConfig(
     ],
 )
 logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
 ### Load Environment Variables ###
 load_dotenv()
@@ -44,6 +49,9 @@ if not all([DISCORD_TOKEN, FIREBASE_CREDENTIALS, REDDIT_CLIENT_ID, REDDIT_CLIENT
 cred = credentials.Certificate(FIREBASE_CREDENTIALS)
 initialize_app(cred)
 firestore_client = firestore.client()
+CHANNEL_CONFIGS = firestore_client.collection("channel_configs")
+SENT_POST_IDS = firestore_client.collection("sent_post_ids")
+firestore_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="firestore")
 
 ### Discord Bot Setup ###
 intents = discord.Intents.default()
@@ -51,40 +59,165 @@ intents.message_content = True
 bot = commands.Bot(command_prefix="/", intents=intents)
 tree = bot.tree
 
+DEFAULT_AVATAR = "https://www.redditstatic.com/avatars/avatar_default_02_46A508.png"
+REDDIT_BASE = "https://www.reddit.com"
+
+# Discord limits for a single webhook message
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARS_PER_MESSAGE = 6000
+MAX_EMBED_TITLE_CHARS = 256
+MAX_EMBED_AUTHOR_CHARS = 256
+MAX_BUTTONS_PER_ROW = 5
+MAX_BUTTON_LABEL_CHARS = 80
+MAX_IMAGES_PER_POST = 4  # Embeds sharing a url are shown as one image group of up to 4 images
+WEBHOOK_MAX_ATTEMPTS = 5
+LINK_BUTTON = {"type": 2, "style": 5}  # Link button; "label" and "url" are filled per post
+JSON_HEADERS = {"Content-Type": "application/json"}
+EMBED_COLOR = 0x3498DB  # discord.Color.blue()
+IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.webp'})
+
 ### Global Variables ###
 http_session = None
 reddit_client = None
 channel_configs = {}
+sent_ids_cache = {}
+channel_configs_watch = None
+watched_subreddits = {}
+channel_semaphore = None
+processing_channels = set()
+channel_tasks = set()
+subreddit_details_cache = TTLCache(maxsize=1024, ttl=600)
+avatar_cache = TTLCache(maxsize=4096, ttl=3600)
+missing_avatar_cache = TTLCache(maxsize=1024, ttl=300)
+inflight_requests = {}
 
 ### Helper Functions ###
 
 async def initialize_http_session():
+    """Return the single HTTP session shared by the bot and the Reddit client, creating it if needed."""
     global http_session
-    if not http_session:
-        http_session = aiohttp.ClientSession()
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=20,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True
+        )
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=15, connect=5),
+            raise_for_status=False
+        )
+    return http_session
 
 async def initialize_reddit_client():
     global reddit_client
     if not reddit_client:
+        session = await initialize_http_session()
         reddit_client = asyncpraw.Reddit(
             client_id=REDDIT_CLIENT_ID,
             client_secret=REDDIT_CLIENT_SECRET,
-            user_agent=REDDIT_USER_AGENT
+            user_agent=REDDIT_USER_AGENT,
+            requestor_kwargs={"session": session}
         )
     return reddit_client
 
 
+async def run_firestore(fn, *args, **kwargs):
+    """
+    Run a blocking Firestore call on the bounded Firestore thread pool.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(firestore_executor, functools.partial(fn, *args, **kwargs))
+
+
+def stream_documents(query):
+    """Materialize a Firestore query's stream; meant to be run via run_firestore."""
+    return list(query.stream())
+
+
+def coalesce(ident):
+    """
+    Collapse concurrent calls that share the same key into a single in-flight request.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args):
+            key = ident(*args)
+            task = inflight_requests.get(key)
+            if task is None:
+                task = asyncio.ensure_future(func(*args))
+                inflight_requests[key] = task
+                task.add_done_callback(lambda _: inflight_requests.pop(key, None))
+            return await asyncio.shield(task)
+        return wrapper
+    return decorator
+
+
 async def load_channel_configs():
-    """Load all channel configurations from Firestore into memory."""
-    global channel_configs
+    """
+    Load all channel configurations from Firestore into memory.
+    The snapshot listener's initial snapshot fills channel_configs, so the collection is only read once.
+    """
+    global channel_configs_watch
     try:
-        configs = firestore_client.collection("channel_configs").stream()
-        for config in configs:
-            data = config.to_dict()
-            channel_configs[data["channel_id"]] = data
+        if not channel_configs_watch:
+            loaded = asyncio.Event()
+            channel_configs_watch = await run_firestore(watch_channel_configs, asyncio.get_running_loop(), loaded)
+            await asyncio.wait_for(loaded.wait(), timeout=30)
+
+        # Load every channel's sent post IDs concurrently on the Firestore pool
+        channel_ids = list(channel_configs)
+        sent_posts_per_channel = await asyncio.gather(*(
+            run_firestore(
+                stream_documents,
+                SENT_POST_IDS.document(channel_id).collection("posts")
+            )
+            for channel_id in channel_ids
+        ))
+        for channel_id, sent_posts in zip(channel_ids, sent_posts_per_channel):
+            sent_ids_cache[channel_id] = {doc.id for doc in sent_posts}
         logger.info("Channel configurations loaded successfully.")
     except Exception as e:
-        logger.error(f"Failed to load channel configurations: {e}")
+        logger.error("Failed to load channel configurations: %s", e)
+
+def apply_channel_config_changes(changes, loaded):
+    """
+    Apply Firestore snapshot changes to the in-memory channel configurations.
+    After the initial snapshot, a channel that starts following a new subreddit is processed right away
+    instead of waiting for the next fetch tick.
+    """
+    for change in changes:
+        channel_id = change.document.id
+        if change.type.name == "REMOVED":
+            channel_configs.pop(channel_id, None)
+            sent_ids_cache.pop(channel_id, None)
+            watched_subreddits.pop(channel_id, None)
+            continue
+
+        data = change.document.to_dict()
+        channel_configs[channel_id] = data
+        subreddit_name = data.get("subreddit")
+        previous_subreddit = watched_subreddits.get(channel_id)
+        watched_subreddits[channel_id] = subreddit_name
+        if loaded.is_set() and subreddit_name and subreddit_name != previous_subreddit:
+            logger.info("Channel %s now follows r/%s. Fetching immediately.", channel_id, subreddit_name)
+            task = asyncio.ensure_future(process_channel(channel_id, data))
+            channel_tasks.add(task)
+            task.add_done_callback(channel_tasks.discard)
+    loaded.set()
+
+def watch_channel_configs(loop, loaded):
+    """
+    Keep channel_configs in sync with Firestore through a real-time snapshot listener.
+    Snapshot callbacks run on a Firestore background thread, so changes are applied on the event loop;
+    `loaded` is set once the initial snapshot has been applied.
+    """
+    def on_snapshot(docs, changes, read_time):
+        loop.call_soon_threadsafe(apply_channel_config_changes, changes, loaded)
+
+    return CHANNEL_CONFIGS.on_snapshot(on_snapshot)
 
 async def update_channel_config(channel_id, data):
     """Update a channel's configuration in Firestore and cache."""
@@ -93,99 +226,96 @@ async def update_channel_config(channel_id, data):
             subreddit_details = await fetch_subreddit_details(data["subreddit"])
             data["bot_name"] = data.get("bot_name", subreddit_details["name"])
             data["bot_avatar"] = data.get("bot_avatar", subreddit_details["icon"])
-        firestore_client.collection("channel_configs").document(channel_id).set(data, merge=True)
-        channel_configs[channel_id] = data
-        logger.info(f"Configuration updated for channel {channel_id}.")
+        await run_firestore(CHANNEL_CONFIGS.document(channel_id).set, data, merge=True)
+        channel_configs.setdefault(channel_id, {}).update(data)
+        logger.info("Configuration updated for channel %s.", channel_id)
     except Exception as e:
-        logger.error(f"Failed to update channel configuration for {channel_id}: {e}")
+        logger.error("Failed to update channel configuration for %s: %s", channel_id, e)
 
 async def reload_channel_config(channel_id):
     """Reload a single channel's configuration."""
     try:
-        doc = firestore_client.collection("channel_configs").document(channel_id).get()
+        doc = await run_firestore(CHANNEL_CONFIGS.document(channel_id).get)
         if doc.exists:
             channel_configs[channel_id] = doc.to_dict()
-            logger.info(f"Configuration for channel {channel_id} reloaded.")
+            logger.info("Configuration for channel %s reloaded.", channel_id)
         else:
             channel_configs.pop(channel_id, None)
-            logger.warning(f"No configuration found for channel {channel_id}.")
+            logger.warning("No configuration found for channel %s.", channel_id)
     except Exception as e:
-        logger.error(f"Failed to reload channel configuration for {channel_id}: {e}")
+        logger.error("Failed to reload channel configuration for %s: %s", channel_id, e)
 
 async def delete_channel_config(channel_id):
     """
     Delete a channel configuration from Firestore and cache.
     """
     try:
-        firestore_client.collection("channel_configs").document(channel_id).delete()
+        await run_firestore(CHANNEL_CONFIGS.document(channel_id).delete)
         channel_configs.pop(channel_id, None)
-        logging.info(f"Configuration deleted for channel {channel_id}.")
+        logger.info("Configuration deleted for channel %s.", channel_id)
     except Exception as e:
-        logging.error(f"Failed to delete channel configuration: {e}")
+        logger.error("Failed to delete channel configuration: %s", e)
 
 
+@coalesce(lambda name: f"sub:{name}")
 async def fetch_subreddit_details(subreddit_name):
-    default_icon = "https://www.redditstatic.com/avatars/avatar_default_02_46A508.png"
+    if subreddit_name in subreddit_details_cache:
+        return subreddit_details_cache[subreddit_name]
     try:
-        global http_session
-        if not http_session:
-            http_session = aiohttp.ClientSession()
-
-        url = f"https://www.reddit.com/r/{subreddit_name}/about.json"
+        url = f"{REDDIT_BASE}/r/{subreddit_name}/about.json"
         headers = {"User-Agent": "RedditBot"}
-        logger.info(f"Fetching subreddit details for r/{subreddit_name} from {url}")
+        logger.info("Fetching subreddit details for r/%s from %s", subreddit_name, url)
 
-        async with http_session.get(url, headers=headers) as response:
+        session = await initialize_http_session()
+        async with session.get(url, headers=headers) as response:
             if response.status != 200:
                 error_text = await response.text()
-                logger.error(f"Failed to fetch details for r/{subreddit_name} (HTTP {response.status}): {error_text}")
-                return {"name": f"r/{subreddit_name}", "icon": default_icon}
+                logger.error("Failed to fetch details for r/%s (HTTP %s): %s", subreddit_name, response.status, error_text)
+                return {"name": f"r/{subreddit_name}", "icon": DEFAULT_AVATAR}
 
             data = await response.json()
-            #logger.debug(f"Raw API response for r/{subreddit_name}: {data}")
+            #logger.debug("Raw API response for r/%s: %s", subreddit_name, data)
 
-            community_icon = data.get("data", {}).get("community_icon", default_icon)
-            parsed_url = urlparse(community_icon)
-            sanitized_url = urlunparse(parsed_url._replace(query=""))
-            logger.info(f"Successfully fetched details for r/{subreddit_name}: Icon={sanitized_url}")
+            community_icon = data.get("data", {}).get("community_icon", DEFAULT_AVATAR)
+            sanitized_url = community_icon.partition('?')[0]
+            logger.info("Successfully fetched details for r/%s: Icon=%s", subreddit_name, sanitized_url)
 
-            return {
+            details = {
                 "name": data.get("data", {}).get("display_name_prefixed", f"r/{subreddit_name}"),
                 "icon": sanitized_url
             }
+            subreddit_details_cache[subreddit_name] = details
+            return details
     except Exception as e:
-        logger.error(f"Error fetching details for r/{subreddit_name}: {e}")
-        return {"name": f"r/{subreddit_name}", "icon": default_icon}
+        logger.error("Error fetching details for r/%s: %s", subreddit_name, e)
+        return {"name": f"r/{subreddit_name}", "icon": DEFAULT_AVATAR}
 
 
 
 async def fetch_reddit_posts(subreddit_name, last_post_id=None):
     try:
         reddit = await initialize_reddit_client()
-        subreddit = await reddit.subreddit(subreddit_name, fetch=True)
+        subreddit = await reddit.subreddit(subreddit_name)
 
-        logger.info(f"Fetching new posts for r/{subreddit_name}")
-        await subreddit.load()
+        logger.info("Fetching new posts for r/%s", subreddit_name)
 
         posts = []
         async for post in subreddit.new(limit=10):
             if last_post_id and post.id == last_post_id:
-                logger.debug(f"Reached last processed post {last_post_id} in r/{subreddit_name}.")
+                logger.debug("Reached last processed post %s in r/%s.", last_post_id, subreddit_name)
                 break
             posts.append(post)
 
             await asyncio.sleep(2)  # Delay between each request to avoid rate limits
 
-        logger.info(f"Fetched {len(posts)} new posts for r/{subreddit_name}.")
+        logger.info("Fetched %s new posts for r/%s.", len(posts), subreddit_name)
         return posts
     except ResponseException as e:
-        logger.error(f"Response error for r/{subreddit_name}: {e}")
+        logger.error("Response error for r/%s: %s", subreddit_name, e)
     except NotFound:
-        logger.error(f"Subreddit r/{subreddit_name} not found.")
+        logger.error("Subreddit r/%s not found.", subreddit_name)
     except Exception as e:
-        logger.error(f"Error fetching posts for r/{subreddit_name}: {e}")
-    finally:
-        await reddit.close()
+        logger.error("Error fetching posts for r/%s: %s", subreddit_name, e)
     return []
 
 
@@ -197,24 +327,58 @@ async def get_or_create_webhook(channel, subreddit_name=None, bot_name=None, bot
             bot_name = bot_name or subreddit_details["name"]
             bot_avatar = bot_avatar or subreddit_details["icon"]
 
-        if isinstance(bot_avatar, str) and bot_avatar.startswith("http"):
-            async with http_session.get(bot_avatar) as response:
-                bot_avatar = await response.read()
-
-        webhooks = await channel.webhooks()
-        webhook = next((wh for wh in webhooks if wh.user == bot.user), None)
-
-        if webhook:
-            await webhook.edit(name=bot_name, avatar=bot_avatar)
+        # Skip the Discord round-trips entirely when the webhook already has this name and avatar
+        cfg = channel_configs.get(str(channel.id), {})
+        name_changed = bool(bot_name) and bot_name != cfg.get("webhook_name")
+        avatar_changed = bool(bot_avatar) and bot_avatar != cfg.get("webhook_avatar")
+        if not name_changed and not avatar_changed and cfg.get("webhook_url"):
+            return cfg["webhook_url"]
+
+        session = await initialize_http_session()
+
+        async def webhook_changes(full):
+            """Build the edit/create kwargs, downloading the avatar only when it is sent."""
+            changes = {}
+            if full or name_changed:
+                changes["name"] = bot_name
+            if full or avatar_changed:
+                avatar = bot_avatar
+                if isinstance(bot_avatar, str) and bot_avatar.startswith("http"):
+                    async with session.get(bot_avatar) as response:
+                        avatar = await response.read()
+                changes["avatar"] = avatar
+            return changes
+
+        # Use the cached webhook URL directly; only list the channel's webhooks when none is known
+        if cfg.get("webhook_url"):
+            webhook = discord.Webhook.from_url(cfg["webhook_url"], session=session)
         else:
-            webhook = await channel.create_webhook(name=bot_name, avatar=bot_avatar)
+            webhooks = await channel.webhooks()
+            webhook = next((wh for wh in webhooks if wh.user == bot.user), None)
 
-        await update_channel_config(str(channel.id), {"webhook_url": webhook.url})
+        full = webhook is None
+        if webhook:
+            try:
+                await webhook.edit(**await webhook_changes(full=False))
+            except discord.errors.NotFound:
+                logger.warning("Cached webhook for %s no longer exists. Recreating it.", channel.name)
+                webhook = None
+        if not webhook:
+            full = True
+            webhook = await channel.create_webhook(**await webhook_changes(full=True))
+
+        applied = {}
+        if full or name_changed:
+            applied["webhook_name"] = bot_name
+        if full or avatar_changed:
+            applied["webhook_avatar"] = bot_avatar
+
+        await update_channel_config(str(channel.id), {"webhook_url": webhook.url, **applied})
         return webhook.url
     except discord.errors.Forbidden:
-        logger.error(f"Bot lacks permissions to create/edit webhooks in {channel.name}.")
+        logger.error("Bot lacks permissions to create/edit webhooks in %s.", channel.name)
     except Exception as e:
-        logger.error(f"Failed to get or create webhook for {channel.name}: {e}")
+        logger.error("Failed to get or create webhook for %s: %s", channel.name, e)
     return None
 
 ### Discord Slash Commands ###
@@ -246,7 +410,7 @@ async def subscribe(interaction: discord.Interaction, subreddit: str, channel: d
         await interaction.followup.send(f"Subscribed to updates from r/{subreddit} in {channel.mention}!", ephemeral=True)
     except Exception as e:
         await interaction.followup.send(f"Failed to subscribe: {e}", ephemeral=True)
-        logger.error(f"Error in subscribe command: {e}")
+        logger.error("Error in subscribe command: %s", e)
 
 @tree.command(name="unsubscribe", description="Unsubscribe a channel from a subreddit.")
 async def unsubscribe(interaction: discord.Interaction, channel: discord.TextChannel):
@@ -256,22 +420,22 @@ async def unsubscribe(interaction: discord.Interaction, channel: discord.TextCha
     """
     await interaction.response.defer(ephemeral=True)
     try:
-        # Delete from `channel_configs`
+        # Delete from `channel_configs` and `sent_post_ids` in a single batch
         channel_id = str(channel.id)
-        firestore_client.collection("channel_configs").document(channel_id).delete()
-        logger.info(f"Deleted channel configuration for channel {channel_id}.")
-
-        # Delete from `sent_post_ids`
-        sent_post_ref = firestore_client.collection("sent_post_ids").document(channel_id)
-        if sent_post_ref.get().exists:  # Check if the document exists before deleting
-            sent_post_ref.delete()
-            logger.info(f"Deleted sent_post_ids for channel {channel_id}.")
-        else:
-            logger.info(f"No sent_post_ids found for channel {channel_id} to delete.")
+        sent_post_ref = SENT_POST_IDS.document(channel_id)
+        batch = firestore_client.batch()
+        batch.delete(CHANNEL_CONFIGS.document(channel_id))
+        for doc in await run_firestore(stream_documents, sent_post_ref.collection("posts")):
+            batch.delete(doc.reference)
+        batch.delete(sent_post_ref)  # Deleting a missing document is a no-op
+        await run_firestore(batch.commit)
+        channel_configs.pop(channel_id, None)
+        sent_ids_cache.pop(channel_id, None)
+        logger.info("Deleted channel configuration and sent_post_ids for channel %s.", channel_id)
 
         await interaction.followup.send(f"Unsubscribed {channel.mention} successfully!", ephemeral=True)
     except Exception as e:
-        logger.error(f"Error during unsubscribe for channel {channel.id}: {e}")
+        logger.error("Error during unsubscribe for channel %s: %s", channel.id, e)
         await interaction.followup.send(f"Failed to unsubscribe {channel.mention}: {e}", ephemeral=True)
 
 
@@ -279,10 +443,9 @@ async def unsubscribe(interaction: discord.Interaction, channel: discord.TextCha
 @tree.command(name="change_avatar", description="Change the bot's avatar for a specific channel")
 @app_commands.describe(channel="The channel to update the avatar for", image_url="URL of the new avatar image")
 async def change_avatar(interaction: discord.Interaction, channel: discord.TextChannel, image_url: str):
+    # Acknowledge the interaction before any Firestore or Discord I/O
+    await interaction.response.defer(ephemeral=True)
     try:
-        # Acknowledge the interaction early
-        await interaction.response.defer(ephemeral=True)
-
         # Update Firestore with the new avatar
         await update_channel_config(str(channel.id), {"bot_avatar": image_url})
 
@@ -291,13 +454,13 @@ async def change_avatar(interaction: discord.Interaction, channel: discord.TextC
 
         # Re-create or edit the webhook with the updated avatar
         bot_name = channel_configs.get(str(channel.id), {}).get("bot_name", bot.user.name)
-        await get_or_create_webhook(channel, bot_name, image_url)
+        await get_or_create_webhook(channel, None, bot_name, image_url)
 
         # Send a follow-up response
         await interaction.followup.send(f"Avatar updated for `{channel.name}`!", ephemeral=True)
     except Exception as e:
         # Handle errors and send a follow-up response
-        logger.error(f"Error in change_avatar command: {e}")
+        logger.error("Error in change_avatar command: %s", e)
         await interaction.followup.send(f"Error changing avatar: {e}", ephemeral=True)
 
 
@@ -305,9 +468,8 @@ async def change_avatar(interaction: discord.Interaction, channel: discord.TextC
 @tree.command(name="change_name", description="Change the bot's name for a specific channel")
 @app_commands.describe(channel="The channel to update the name for", name="The new name for the bot")
 async def change_name(interaction: discord.Interaction, channel: discord.TextChannel, name: str):
+    await interaction.response.defer(ephemeral=True)  # Defer the response
     try:
-        await interaction.response.defer(ephemeral=True)  # Defer the response
-
         # Update Firestore
         await update_channel_config(str(channel.id), {"bot_name": name})
 
@@ -322,255 +484,415 @@ async def change_name(interaction: discord.Interaction, channel: discord.TextCha
         await interaction.followup.send(f"Name updated to `{name}` for `{channel.name}`!", ephemeral=True)
     except Exception as e:
         await interaction.followup.send(f"Error changing name: {e}", ephemeral=True)
-        logger.error(f"Error in change_name command: {e}")
+        logger.error("Error in change_name command: %s", e)
 
 ### Periodic Reddit Fetch Task ###
 # Helper: Send message via webhook
-async def send_message_with_webhook(webhook_url, content=None, embeds=None, username=None, avatar_url=None, post_link=None):
+async def send_message_with_webhook(webhook_url, content=None, embeds=None, username=None, avatar_url=None, post_links=None):
     """
-    Sends a message to a Discord webhook.
+    Sends a message to a Discord webhook, with one link button per (title, url) pair in post_links.
+    Rate limits and transient errors are retried up to WEBHOOK_MAX_ATTEMPTS times.
+    Returns True on success, False on failure, and None if the webhook no longer exists.
     """
     try:
+        buttons = [
+            {**LINK_BUTTON, "label": post_title[:MAX_BUTTON_LABEL_CHARS], "url": post_link}
+            for post_title, post_link in post_links or ()
+        ]
         payload = {
             "content": content,
-            "embeds": [embed.to_dict() for embed in embeds] if embeds else None,
+            "embeds": embeds or None,
             "username": username,
             "avatar_url": avatar_url,
             "components": [
-                {
-                    "type": 1,
-                    "components": [
-                        {
-                            "type": 2,
-                            "label": "View Post",
-                            "style": 5,  # Link button
-                            "url": post_link,
-                        }
-                    ],
-                }
-            ] if post_link else None,
+                {"type": 1, "components": buttons[i:i + MAX_BUTTONS_PER_ROW]}
+                for i in range(0, len(buttons), MAX_BUTTONS_PER_ROW)
+            ] or None,
         }
 
-        async with http_session.post(webhook_url, json=payload) as response:
-            if response.status in {200, 204}:
-                logging.info(f"Message sent successfully via webhook to {webhook_url}")
-            else:
-                logging.error(f"Failed to send message. Status: {response.status}, Body: {await response.text()}")
+        body = orjson.dumps(payload)
     except Exception as e:
-        logging.error(f"Error sending message with webhook: {e}")
+        logger.error("Error building webhook payload: %s", e)
+        return False
+
+    for attempt in range(WEBHOOK_MAX_ATTEMPTS):
+        try:
+            session = await initialize_http_session()
+            async with session.post(webhook_url, data=body, headers=JSON_HEADERS) as response:
+                if response.status in {200, 204}:
+                    logger.info("Message sent successfully via webhook to %s", webhook_url)
+                    return True
+                if response.status == 404:
+                    logger.warning("Webhook %s no longer exists.", webhook_url)
+                    return None
+                if response.status == 429:
+                    delay = float(response.headers.get("Retry-After", 1))
+                    logger.warning("Rate limited by Discord. Retrying in %s seconds.", delay)
+                elif response.status < 500:
+                    logger.error("Failed to send message. Status: %s, Body: %s", response.status, await response.text())
+                    return False
+                else:
+                    delay = min(2 ** attempt, 30)
+                    logger.warning("Discord returned HTTP %s. Retrying in %s seconds.", response.status, delay)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            delay = min(2 ** attempt, 30)
+            logger.warning("Error sending message with webhook: %s. Retrying in %s seconds.", e, delay)
+        except Exception as e:
+            logger.error("Error sending message with webhook: %s", e)
+            return False
+        if attempt < WEBHOOK_MAX_ATTEMPTS - 1:
+            await asyncio.sleep(delay)
+
+    logger.error("Giving up on webhook message after %s attempts.", WEBHOOK_MAX_ATTEMPTS)
+    return False
+
+# Helper: Extract media
+def extract_media(post):
+    """
+    Returns the image URLs for a Reddit post: gallery items, a direct image link, or the preview image.
+    """
+    if getattr(post, "is_gallery", False):
+        media_metadata = getattr(post, "media_metadata", None) or {}
+        gallery_items = (getattr(post, "gallery_data", None) or {}).get("items", ())
+        media_urls = []
+        for media_item in gallery_items:
+            media_url = media_metadata.get(media_item.get("media_id"), {}).get("s", {}).get("u")
+            if media_url:
+                media_urls.append(media_url)
+        return media_urls
+
+    url = post.url
+    if url and os.path.splitext(url.partition('?')[0])[1].lower() in IMAGE_EXTENSIONS:
+        return [url]
+
+    preview = getattr(post, "preview", None)
+    if isinstance(preview, dict):
+        preview_images = preview.get("images")
+        if preview_images:
+            media_url = preview_images[0].get("source", {}).get("url")
+            if media_url:
+                return [media_url]
+    return []
 
 # Helper: Create embeds
 async def create_embeds(post, subreddit_name, media_urls):
     """
     Creates Discord embeds for a Reddit post.
     """
-    author_avatar = await fetch_reddit_avatar(post.author.name) if post.author else \
-        "https://www.redditstatic.com/avatars/avatar_default_02_46A508.png"
+    author_avatar = await fetch_reddit_avatar(post.author.name) if post.author else DEFAULT_AVATAR
+
+    # Shared by every embed of this post
+    permalink_url = f"{REDDIT_BASE}{post.permalink}"
+    author_name = f"u/{post.author.name}" if post.author else "Anonymous"
+    footer_text = f"Subreddit: r/{subreddit_name}"
 
     embeds = []
 
     if media_urls:  # If there are images or media
-        for image_url in media_urls[:4]:  # Limit to 4 images
-            embed = discord.Embed(
+        for image_url in media_urls[:MAX_IMAGES_PER_POST]:
+            embeds.append(build_embed(
                 title=post.title,
-                url=f"https://www.reddit.com{post.permalink}",
-                color=discord.Color.blue()
-            )
-            embed.set_author(name=f"u/{post.author.name}" if post.author else "Anonymous", icon_url=author_avatar)
-            embed.set_image(url=image_url)
-            embed.set_footer(text=f"Subreddit: r/{subreddit_name}")
-            embeds.append(embed)
+                url=permalink_url,
+                author_name=author_name,
+                author_icon=author_avatar,
+                image_url=image_url,
+                footer=footer_text
+            ))
     elif post.selftext:  # If the post has text content (selftext)
-        embed = discord.Embed(
+        embeds.append(build_embed(
             title=post.title,
-            url=f"https://www.reddit.com{post.permalink}",
+            url=permalink_url,
+            author_name=author_name,
+            author_icon=author_avatar,
             description=post.selftext[:2048],  # Discord embed limit for description
-            color=discord.Color.blue()
-        )
-        embed.set_author(name=f"u/{post.author.name}" if post.author else "Anonymous", icon_url=author_avatar)
-        embed.set_footer(text=f"Subreddit: r/{subreddit_name}")
-        embeds.append(embed)
+            footer=footer_text
+        ))
     else:  # Fallback for unsupported or empty content
-        embed = discord.Embed(
+        embeds.append(build_embed(
             title=post.title,
-            url=f"https://www.reddit.com{post.permalink}",
-            color=discord.Color.blue()
-        )
-        embed.set_author(name=f"u/{post.author.name}" if post.author else "Anonymous", icon_url=author_avatar)
-        embed.set_footer(text=f"Subreddit: r/{subreddit_name}")
-        embeds.append(embed)
+            url=permalink_url,
+            author_name=author_name,
+            author_icon=author_avatar,
+            footer=footer_text
+        ))
 
     return embeds
 
+def build_embed(title, url, author_name, author_icon, image_url=None, description=None, footer=""):
+    """
+    Builds a raw Discord embed payload, leaving out fields that are not set.
+    Raw payloads are not validated client-side, so the title and author are cut to Discord's limits here.
+    """
+    embed = {
+        "title": title[:MAX_EMBED_TITLE_CHARS],
+        "url": url,
+        "author": {"name": author_name[:MAX_EMBED_AUTHOR_CHARS], "icon_url": author_icon},
+        "footer": {"text": footer},
+        "color": EMBED_COLOR,
+    }
+    if image_url:
+        embed["image"] = {"url": image_url}
+    if description:
+        embed["description"] = description
+    return embed
+
+def embed_length(embed):
+    """
+    Counts the characters of an embed payload that Discord applies the 6000-character limit to.
+    """
+    return (len(embed.get("title", "")) + len(embed.get("description", "")) +
+            len(embed["author"]["name"]) + len(embed["footer"]["text"]))
+
 # Helper: Fetch Reddit avatar
+@coalesce(lambda username: f"av:{username}")
 async def fetch_reddit_avatar(username):
     """
     Fetch the Reddit avatar for the post author using the Reddit API.
     """
-    default_avatar = "https://www.redditstatic.com/avatars/avatar_default_02_46A508.png"
+    if username in avatar_cache:
+        return avatar_cache[username]
+    if username in missing_avatar_cache:
+        return DEFAULT_AVATAR
 
     try:
         reddit = await initialize_reddit_client()
         user = await reddit.redditor(username, fetch=True)  # Fetch the user data
-        avatar_url = getattr(user, "icon_img", default_avatar)  # Get the avatar URL
-        return avatar_url.split('?')[0]  # Clean URL
+        avatar_url = getattr(user, "icon_img", DEFAULT_AVATAR)  # Get the avatar URL
+        avatar_cache[username] = avatar_url.partition('?')[0]  # Clean URL
+        return avatar_cache[username]
     except Exception as e:
-        logger.error(f"Error fetching avatar for {username}: {e}")
-        return default_avatar
+        logger.error("Error fetching avatar for %s: %s", username, e)
+        missing_avatar_cache[username] = True  # Don't hammer deleted/suspended users
+        return DEFAULT_AVATAR
 
 
-# Task: Fetch Reddit posts and post them to Discord
-@tasks.loop(minutes=1)
-async def fetch_reddit_and_post():
+async def fetch_new_posts(subreddit_name):
     """
-    Periodically fetches the latest Reddit posts and posts them to Discord.
+    Fetches the most recent posts of a subreddit, newest first.
+    The listing is shared by every channel following the subreddit, so it does not depend on any
+    channel's last post; each channel filters it by its own timestamp and sent post IDs.
     """
-    logger.info("Starting fetch task for all subscribed subreddits.")
-    try:
-        configs = firestore_client.collection("channel_configs").stream()
-        for config in configs:
-            data = config.to_dict()
-            subreddit_name = data.get("subreddit")
-            channel_id = data.get("channel_id")
-            webhook_url = data.get("webhook_url")
-            last_post_timestamp = float(data.get("last_post_timestamp", 0))
-
-            if not subreddit_name or not webhook_url:
-                logger.warning(f"Skipping channel {channel_id}: Missing subreddit or webhook URL.")
-                continue
+    # Listings don't need the subreddit's metadata, so skip loading it
+    reddit = await initialize_reddit_client()
+    subreddit = await reddit.subreddit(subreddit_name)
+    return [post async for post in subreddit.new(limit=50)]
 
-            try:
-                logger.info(f"Processing subreddit r/{subreddit_name} for channel {channel_id}.")
-
-                # Initialize Reddit client and load subreddit details
-                reddit = await initialize_reddit_client()
-                subreddit = await reddit.subreddit(subreddit_name)
-                await subreddit.load()
-
-                # Fetch subreddit details if missing
-                if not data.get("bot_name") or not data.get("bot_avatar"):
-                    subreddit_details = await fetch_subreddit_details(subreddit_name)
-                    data["bot_name"] = subreddit_details["name"]
-                    data["bot_avatar"] = subreddit_details["icon"]
-                    await update_channel_config(channel_id, data)
-                    logger.info(f"Updated subreddit details for r/{subreddit_name}: {subreddit_details}")
-
-                bot_name = data.get("bot_name", "DefaultBot")
-                bot_avatar = data.get(
-                    "bot_avatar",
-                    "https://www.redditstatic.com/avatars/avatar_default_02_46A508.png"
-                )
-
-                # Fetch new posts
-                new_posts = []
-                async for post in subreddit.new(limit=50):
-                    if float(post.created_utc) > last_post_timestamp:
-                        new_posts.append(post)
 
-                if not new_posts:
-                    logger.info(f"No new posts found for r/{subreddit_name}.")
-                    continue
-
-                new_posts.reverse()  # Process from oldest to newest
-                logger.info(f"Found {len(new_posts)} new posts for r/{subreddit_name}.")
+async def process_channel(channel_id, data, posts=None):
+    """
+    Posts a channel's new Reddit posts to Discord.
+    `posts` is the subreddit listing shared by every channel following it; when omitted it is fetched here.
+    """
+    subreddit_name = data.get("subreddit")
+    webhook_url = data.get("webhook_url")
+    last_post_timestamp = float(data.get("last_post_timestamp", 0))
+
+    if not subreddit_name:
+        logger.warning("Skipping channel %s: Missing subreddit.", channel_id)
+        return
+
+    async with channel_semaphore:
+        # A tick and a listener-triggered fetch must not post the same channel concurrently
+        if channel_id in processing_channels:
+            logger.info("Channel %s is already being processed. Skipping.", channel_id)
+            return
+        processing_channels.add(channel_id)
+        try:
+            logger.info("Processing subreddit r/%s for channel %s.", subreddit_name, channel_id)
+
+            # Fetch subreddit details if missing
+            if not data.get("bot_name") or not data.get("bot_avatar"):
+                subreddit_details = await fetch_subreddit_details(subreddit_name)
+                data["bot_name"] = subreddit_details["name"]
+                data["bot_avatar"] = subreddit_details["icon"]
+                await update_channel_config(channel_id, data)
+                logger.info("Updated subreddit details for r/%s: %s", subreddit_name, subreddit_details)
+
+            bot_name = data.get("bot_name", "DefaultBot")
+            bot_avatar = data.get("bot_avatar", DEFAULT_AVATAR)
+
+            # Recreate the webhook if it was deleted since the last send
+            if not webhook_url:
+                channel = bot.get_channel(int(channel_id))
+                webhook_url = await get_or_create_webhook(channel, subreddit_name, bot_name, bot_avatar) if channel else None
+                if not webhook_url:
+                    logger.warning("Skipping channel %s: No webhook available.", channel_id)
+                    return
+
+            if posts is None:
+                posts = await fetch_new_posts(subreddit_name)
+            new_posts = [post for post in posts if float(post.created_utc) > last_post_timestamp]
+
+            if not new_posts:
+                logger.info("No new posts found for r/%s.", subreddit_name)
+                return
+
+            new_posts.reverse()  # Process from oldest to newest
+            logger.info("Found %s new posts for r/%s.", len(new_posts), subreddit_name)
+
+            sent_posts = []
+            pending_posts = []
+            pending_embeds = []
+
+            async def flush_pending():
+                """
+                Send all buffered embeds as a single webhook message.
+                Only posts whose message was delivered are recorded as sent. Returns a falsy value if the send failed.
+                """
+                if not pending_posts:
+                    return True
+                delivered = await send_message_with_webhook(
+                    webhook_url=webhook_url,
+                    embeds=list(pending_embeds),
+                    username=bot_name,
+                    avatar_url=bot_avatar,
+                    post_links=[(post.title, f"{REDDIT_BASE}{post.permalink}") for post in pending_posts]
+                )
+                if delivered:
+                    sent_posts.extend(pending_posts)
+                    # Mark them right away so an error later in this run cannot send them again
+                    sent_ids_cache.setdefault(channel_id, set()).update(post.id for post in pending_posts)
+                elif delivered is None:
+                    # The webhook was deleted; forget it in Firestore too so the next run recreates it
+                    data.pop("webhook_url", None)
+                    channel_configs.get(channel_id, {}).pop("webhook_url", None)
+                    await run_firestore(CHANNEL_CONFIGS.document(channel_id).update, {"webhook_url": firestore.DELETE_FIELD})
+                    logger.info("Cleared the deleted webhook for channel %s. It will be recreated.", channel_id)
+                pending_embeds.clear()
+                pending_posts.clear()
+                return delivered
 
+            try:
+                delivered = True
+                seen_ids = set()
                 for post in new_posts:
-                    logger.debug(f"Processing post {post.id} from r/{subreddit_name}.")
+                    logger.debug("Processing post %s from r/%s.", post.id, subreddit_name)
 
-                    # Skip duplicates
-                    if await is_duplicate_post(channel_id, post.id):
-                        logger.info(f"Post {post.id} already processed for channel {channel_id}. Skipping.")
+                    # Skip duplicates, including posts repeated within this listing
+                    if post.id in seen_ids or await is_duplicate_post(channel_id, post.id):
+                        logger.info("Post %s already processed for channel %s. Skipping.", post.id, channel_id)
                         continue
+                    seen_ids.add(post.id)
 
-                    # Process media
-                    media_urls = []
+                    # Process media and create embeds; a post with an unexpected shape is skipped, not the whole burst
                     try:
-                        if hasattr(post, "gallery_data") and hasattr(post, "media_metadata"):
-                            for media_item in post.gallery_data.get("items", []):
-                                media_id = media_item.get("media_id")
-                                if media_id and media_id in post.media_metadata:
-                                    media_data = post.media_metadata[media_id]
-                                    media_url = media_data.get("s", {}).get("u")
-                                    if media_url:
-                                        media_urls.append(media_url)
-                        elif post.url and post.url.endswith(('.jpg', '.png', '.gif')):
-                            media_urls.append(post.url)
-                        elif hasattr(post, "preview") and isinstance(post.preview, dict):
-                            preview_images = post.preview.get("images", [])
-                            if preview_images:
-                                media_url = preview_images[0].get("source", {}).get("url")
-                                if media_url:
-                                    media_urls.append(media_url)
-
+                        media_urls = extract_media(post)
                         if not media_urls:
-                            logger.warning(f"No media found for post {post.id} in r/{subreddit_name}.")
-                    except (KeyError, AttributeError) as e:
-                        logger.warning(f"Error while processing media for post {post.id}: {e}")
+                            logger.warning("No media found for post %s in r/%s.", post.id, subreddit_name)
+                        embeds = await create_embeds(post, subreddit_name, media_urls)
                     except Exception as e:
-                        logger.error(f"Unexpected error processing media for post {post.id}: {e}")
+                        logger.error("Unexpected error processing media for post %s: %s", post.id, e)
                         continue
 
-                    # Create embeds and send to Discord
-                    embeds = await create_embeds(post, subreddit_name, media_urls)
-                    await send_message_with_webhook(
-                        webhook_url=webhook_url,
-                        embeds=embeds,
-                        username=bot_name,
-                        avatar_url=bot_avatar,
-                        post_link=f"https://www.reddit.com{post.permalink}"
-                    )
-
-                    # Update sent_post_ids and Firestore
-                    await add_to_sent_post_ids(channel_id, post.id)
-                    firestore_client.collection("channel_configs").document(config.id).update({
-                        "last_post_id": post.id,
-                        "last_post_timestamp": post.created_utc
-                    })
-                    logger.info(f"Updated last_post_id ({post.id}) and last_post_timestamp ({post.created_utc}) for channel {channel_id}.")
-
-            except Exception as e:
-                logger.error(f"Error processing subreddit r/{subreddit_name} for channel {channel_id}: {e}")
+                    # Buffer the embeds, flushing when the next post would not fit
+                    if (len(pending_embeds) + len(embeds) > MAX_EMBEDS_PER_MESSAGE or
+                            sum(map(embed_length, pending_embeds + embeds)) > MAX_EMBED_CHARS_PER_MESSAGE):
+                        delivered = await flush_pending()
+                        if not delivered:
+                            # Stop here so the undelivered posts are retried on the next tick
+                            break
+                    pending_embeds.extend(embeds)
+                    pending_posts.append(post)
+
+                if delivered:
+                    await flush_pending()
+            finally:
+                # Commit sent_post_ids and the channel's last delivered post in a single batch,
+                # even when a later post failed, so nothing already posted is sent again
+                if sent_posts:
+                    last_sent = sent_posts[-1]
+                    last_post = {
+                        "last_post_id": last_sent.id,
+                        "last_post_timestamp": last_sent.created_utc
+                    }
+                    batch = firestore_client.batch()
+                    await add_to_sent_post_ids(channel_id, sent_posts, batch)
+                    batch.update(CHANNEL_CONFIGS.document(channel_id), last_post)
+                    await run_firestore(batch.commit)
+                    data.update(last_post)
+                    logger.info("Updated last_post_id (%s) and last_post_timestamp (%s) for channel %s.", last_sent.id, last_sent.created_utc, channel_id)
+
+        except Exception as e:
+            logger.error("Error processing subreddit r/%s for channel %s: %s", subreddit_name, channel_id, e)
+        finally:
+            processing_channels.discard(channel_id)
+
+
+async def process_subreddit(subreddit_name, channels):
+    """
+    Fetches a subreddit once and posts its new posts to every channel following it.
+    """
+    try:
+        async with channel_semaphore:
+            posts = await fetch_new_posts(subreddit_name)
+    except Exception as e:
+        logger.error("Error fetching posts for r/%s: %s", subreddit_name, e)
+        return
+
+    results = await asyncio.gather(
+        *(process_channel(channel_id, data, posts) for channel_id, data in channels),
+        return_exceptions=True
+    )
+    for (channel_id, _), result in zip(channels, results):
+        if isinstance(result, Exception):
+            logger.error("Unhandled error processing channel %s: %s", channel_id, result)
+
 
+# Task: Fetch Reddit posts and post them to Discord
+@tasks.loop(minutes=1)
+async def fetch_reddit_and_post():
+    """
+    Periodically fetches the latest Reddit posts and posts them to Discord.
+    """
+    logger.info("Starting fetch task for all subscribed subreddits.")
+    try:
+        # Group channels by subreddit so each subreddit is fetched only once per tick
+        by_subreddit = defaultdict(list)
+        for channel_id, data in list(channel_configs.items()):
+            if not data.get("subreddit"):
+                logger.warning("Skipping channel %s: Missing subreddit.", channel_id)
+                continue
+            by_subreddit[data["subreddit"]].append((channel_id, data))
+
+        await asyncio.gather(*(
+            process_subreddit(subreddit_name, channels) for subreddit_name, channels in by_subreddit.items()
+        ))
     except Exception as e:
-        logger.error(f"Error in fetch_reddit_and_post task: {e}")
+        logger.error("Error in fetch_reddit_and_post task: %s", e)
 
 
 
 async def is_duplicate_post(channel_id, post_id):
     """
     Check if a post ID already exists in sent_post_ids for the given channel.
+    Served from the in-memory cache mirrored from Firestore.
     """
-    try:
-        sent_posts_ref = firestore_client.collection("sent_post_ids").document(channel_id).collection("posts")
-        docs = sent_posts_ref.stream()
-        for doc in docs:
-            if post_id in doc.to_dict().get("post_ids", []):
-                return True
-        return False
-    except Exception as e:
-        logging.error(f"Error checking duplicate posts for channel {channel_id}: {e}")
-        return True
+    return post_id in sent_ids_cache.get(channel_id, ())
 
 
-async def add_to_sent_post_ids(channel_id, post_id):
+async def add_to_sent_post_ids(channel_id, posts, batch):
     """
-    Add a post ID to the sent_post_ids collection for the channel.
-    Keep only the last 50 IDs to avoid exceeding Firestore limits.
+    Add posts to the sent_post_ids collection for the channel as part of a write batch.
+    Each post is stored as its own document keyed by post ID; entries older than
+    the oldest post in this batch can no longer be refetched and are culled.
     """
     try:
-        sent_post_ref = firestore_client.collection("sent_post_ids").document(channel_id)
-        sent_post_data = sent_post_ref.get().to_dict() if sent_post_ref.get().exists else {"post_ids": []}
+        sent_posts_ref = SENT_POST_IDS.document(channel_id).collection("posts")
+        sent_ids = sent_ids_cache.setdefault(channel_id, set())
+        sent_ids.update(post.id for post in posts)
+        cutoff = min(float(post.created_utc) for post in posts)
 
-        if post_id not in sent_post_data["post_ids"]:
-            sent_post_data["post_ids"].append(post_id)
+        stale_posts = await run_firestore(stream_documents, sent_posts_ref.where("ts", "<", cutoff).limit(400))
+        for doc in stale_posts:
+            sent_ids.discard(doc.id)
+            batch.delete(doc.reference)
 
-        # Keep only the last 50 post IDs
-        sent_post_data["post_ids"] = sent_post_data["post_ids"][-50:]
+        for post in posts:
+            batch.set(sent_posts_ref.document(post.id), {"ts": post.created_utc})
 
-        sent_post_ref.set(sent_post_data)
-        logging.info(f"Added post {post_id} to sent_post_ids for channel {channel_id}.")
+        logger.info("Added posts %s to sent_post_ids for channel %s.", [post.id for post in posts], channel_id)
     except Exception as e:
-        logging.error(f"Failed to update sent_post_ids for channel {channel_id}: {e}")
+        logger.error("Failed to update sent_post_ids for channel %s: %s", channel_id, e)
 
 
 
@@ -578,26 +900,41 @@ async def add_to_sent_post_ids(channel_id, post_id):
 
 @bot.event
 async def on_ready():
+    global channel_semaphore
+    if not channel_semaphore:
+        channel_semaphore = asyncio.Semaphore(10)
     await initialize_http_session()
     await initialize_reddit_client()
     await load_channel_configs()
     fetch_reddit_and_post.start()
     await bot.tree.sync()
-    logger.info(f"Logged in as {bot.user}.")
+    logger.info("Logged in as %s.", bot.user)
 
-@bot.event
-async def on_close():
+async def shutdown():
+    """
+    Release the bot's shared resources. discord.py has no on_close event, so main() calls this on exit.
+    """
+    if not bot.is_closed():
+        await bot.close()
+    if channel_configs_watch:
+        channel_configs_watch.unsubscribe()
+    if reddit_client:
+        await reddit_client.close()
     if http_session and not http_session.closed:
         await http_session.close()
+    firestore_executor.shutdown(wait=False)
     logger.info("Bot shutting down.")
 
 ### Main Entry Point ###
 
 async def main():
-    await bot.start(DISCORD_TOKEN)
+    try:
+        await bot.start(DISCORD_TOKEN)
+    finally:
+        await shutdown()
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except Exception as e:
-        logger.critical(f"Failed to start bot: {e}")
\ No newline at end of file
+        logger.critical("Failed to start bot: %s", e)
\ No newline at end of file